@@ -1,9 +1,23 @@
-import binascii
 import io
+import itertools
+import json
+import mmap
 import os
-from struct import unpack
+from struct import iter_unpack, unpack, unpack_from
 import sys
 import csv
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stdout
+import multiprocessing
+
+GAME_LOOKUP_CACHE_VERSION = 1  # Bump when the layout of game_lookup changes
+EXECUTION_INFO_HEADER_ID = 0x00040006  # Xex optional header holding the execution info
+SCAN_CACHE_FILE = 'GameInfo.cache.json'
+SCAN_CACHE_VERSION = 1  # Bump when what parse() returns changes
+MEDIA_TAG = b'MICROSOFT*XBOX*MEDIA'
+XEX_MAGIC = b'XEX2'
 
 def get_data_file_path(filename):
     if hasattr(sys, '_MEIPASS'):
@@ -14,12 +28,24 @@ def get_data_file_path(filename):
         return filename
 
 class Xbox360ISO(object):
-    def __init__(self):
-        self.iso_type = {'GDF': 0xfd90000,
-                         'XGD3': 0x2080000,
-                         'XSF': 0}
+    SECTOR_SIZE = 0x800
+    # Where the volume starts in the image for each layout
+    ROOT_OFFSETS = {'GDF': 0xfd90000,
+                    'XGD3': 0x2080000,
+                    'XSF': 0}
+    # The volume descriptor is in sector 0x20 of the volume, probed in this
+    # order, the first layout with the media tag wins
+    DESCRIPTOR_OFFSETS = (('XSF', ROOT_OFFSETS['XSF'] + 0x20 * SECTOR_SIZE),
+                          ('GDF', ROOT_OFFSETS['GDF'] + 0x20 * SECTOR_SIZE),
+                          ('XGD3', ROOT_OFFSETS['XGD3'] + 0x20 * SECTOR_SIZE))
+
+    def __init__(self, game_lookup=None):
+        self.iso_type = dict(self.ROOT_OFFSETS)  # Kept for existing callers
         self.csv_file = get_data_file_path('xbox360_gamelist.csv')
-        self.game_lookup = self.load_game_lookup()
+        self.csv_stamp = None  # SHA-1 of the CSV game_lookup was read from
+        if game_lookup is None:
+            game_lookup = self.load_game_lookup()
+        self.game_lookup = game_lookup
 
     def load_game_lookup(self):
         game_lookup = {}
@@ -28,150 +54,163 @@ class Xbox360ISO(object):
             return game_lookup
 
         try:
-            with open(self.csv_file, mode='r', newline='', encoding='utf-8') as csvfile:
-                reader = csv.reader(csvfile)
-                headers = next(reader)  # Skip the header row
-                for row in reader:
-                    if len(row) > 7:
-                        game_lookup[row[1].strip().upper()] = {
-                            'game_name': row[0].strip(),
-                            'serial': row[2].strip(),
-                            'type': row[3].strip(),
-                            'region': row[4].strip(),
-                            'xex_crc': row[5].strip(),
-                            'media_id': row[6].strip(),
-                            'wave': row[7].strip()
-                       }
+            with open(self.csv_file, 'rb') as csvfile:
+                csv_data = csvfile.read()
+        except OSError as e:
+            print(f"Failed to read CSV file: {e}")
+            return game_lookup
+        # Hash the content, the exe re-extracts the CSV with a new mtime every launch
+        self.csv_stamp = hashlib.sha1(csv_data).hexdigest()
+
+        # The bundled exe extracts the CSV to a new temp folder on every launch,
+        # so a cache next to it would never be reused there
+        use_cache = not hasattr(sys, '_MEIPASS')
+        # JSON rather than pickle, as a relative csv_file puts the cache in the
+        # folder being scanned. Only used for the exact CSV it was built from.
+        cache_file = self.csv_file + '.json'
+        try:
+            if use_cache:
+                with open(cache_file, 'r', encoding='utf-8') as f:
+                    version, stamp, entries = json.load(f)
+                if version == GAME_LOOKUP_CACHE_VERSION and stamp == self.csv_stamp:
+                    return {bytes.fromhex(title_id): game_info for title_id, game_info in entries.items()}
+        except Exception:
+            pass  # No usable cache, fall back to the CSV
+
+        try:
+            lines = csv_data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n').split('\n')
+            for line in lines[1:]:  # Skip the header row
+                # Only quoted lines (a comma inside a field) need the csv module
+                row = next(csv.reader([line])) if '"' in line else line.split(',')
+                if len(row) > 7:
+                    try:
+                        # Keyed by the raw 4 title ID bytes as read from the XEX
+                        title_id = bytes.fromhex(row[1].strip())
+                    except ValueError:
+                        continue
+                    game_lookup[title_id] = {
+                        'game_name': row[0].strip(),
+                        'serial': row[2].strip(),
+                        'type': row[3].strip(),
+                        'region': row[4].strip(),
+                        'xex_crc': row[5].strip(),
+                        'media_id': row[6].strip(),
+                        'wave': row[7].strip()
+                   }
         except Exception as e:
             print(f"Failed to read CSV file: {e}")
+            return game_lookup
+
+        if not use_cache:
+            return game_lookup
+
+        try:
+            # Write to a temp file first so a half written cache is never loaded
+            entries = {title_id.hex(): game_info for title_id, game_info in game_lookup.items()}
+            with open(cache_file + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump([GAME_LOOKUP_CACHE_VERSION, self.csv_stamp, entries], f)
+            os.replace(cache_file + '.tmp', cache_file)
+        except OSError:
+            pass  # Folder may be read-only, the cache is only a speedup
 
         return game_lookup
 
     def parse(self, filename):
         try:
             with open(filename, "rb") as iso_file:
-                iso_info = self.check_iso(iso_file)
-                if iso_info is False:
+                # mmap rejects empty files, and no layout fits in 0 bytes anyway
+                if os.fstat(iso_file.fileno()).st_size == 0:
+                    print('Unknown ISO format')
                     return None
 
-                xex_buffer = self.extract_defaultxex(iso_file, iso_info)
-                if xex_buffer is False:
-                    return None
+                with mmap.mmap(iso_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    iso_info = self.check_iso(mm)
+                    if iso_info is False:
+                        return None
 
-                xex_info = self.extract_xex_info(xex_buffer)
-                if xex_info is False:
-                    return None
+                    root_start = (iso_info['root_dir_sector'] * iso_info['sector_size']) + iso_info['root_offset']
+                    root_buf = mm[root_start:root_start + iso_info['root_dir_size']]
 
-                # Fetch game info from the loaded game lookup dictionary
-                title_id = xex_info.get('title_id', 'Unknown')
-                game_info = self.game_lookup.get(title_id, {})
-                xex_info.update(game_info)
-                xex_info['title_id'] = title_id
+                    # Directory entries are: sector(4) size(4) attributes(1) name_length(1) name
+                    pos = root_buf.lower().find(b'\x0bdefault.xex')
+                    if pos < 9:
+                        print('default.xex not found')
+                        return None
+                    file_sector, file_size = unpack('<II', root_buf[pos - 9:pos - 1])
+                    xex_start = iso_info['root_offset'] + (file_sector * iso_info['sector_size'])
 
-                props = iso_info.copy()
-                props.update(xex_info)
+                    xex_info = self.extract_xex_info(mm, xex_start, file_size)
+                    if xex_info is False:
+                        return None
 
-                return props
+                    props = iso_info.copy()
+                    props.update(xex_info)
+
+                    return props
         except Exception as e:
             print(f"Failed to parse {filename}: {e}")
             return None
 
-    def check_iso(self, iso_file):
-        iso_info = {'sector_size': 0x800}
-        iso_file.seek((0x20 * iso_info['sector_size']))
-        if iso_file.read(20).decode("ascii", "ignore") == 'MICROSOFT*XBOX*MEDIA':
-            iso_info['root_offset'] = self.iso_type['XSF']
+    def check_iso(self, mm):
+        iso_info = {'sector_size': self.SECTOR_SIZE}
+        # Each probe takes the identifier plus root_dir_sector/root_dir_size,
+        # so the matching slice already holds the whole volume descriptor.
+        for layout, offset in self.DESCRIPTOR_OFFSETS:
+            descriptor = mm[offset:offset + 28]
+            if descriptor.startswith(MEDIA_TAG):
+                break
+        else:
+            print('Unknown ISO format')
+            return False
+        iso_info['root_offset'] = self.ROOT_OFFSETS[layout]
+        if layout == 'XSF':
             print('Original Xbox ISO format not supported')
             return False
-        else:
-            iso_file.seek((0x20 * iso_info['sector_size']) + self.iso_type['GDF'])
-            if iso_file.read(20).decode("ascii", "ignore") == 'MICROSOFT*XBOX*MEDIA':
-                iso_info['root_offset'] = self.iso_type['GDF']
-            else:
-                iso_file.seek((0x20 * iso_info['sector_size']) + self.iso_type['XGD3'])
-                if iso_file.read(20).decode("ascii", "ignore") == 'MICROSOFT*XBOX*MEDIA':
-                    iso_info['root_offset'] = self.iso_type['XGD3']
-                else:
-                    print('Unknown ISO format')
-                    return False
-        iso_file.seek((0x20 * iso_info['sector_size']) + iso_info['root_offset'])
-        iso_info['identifier'] = iso_file.read(20).decode("ascii", "ignore")
-        iso_info['root_dir_sector'] = unpack('I', iso_file.read(4))[0]
-        iso_info['root_dir_size'] = unpack('I', iso_file.read(4))[0]
-        iso_info['image_size'] = os.fstat(iso_file.fileno()).st_size
+        iso_info['identifier'] = descriptor[:20].decode("ascii", "ignore")
+        iso_info['root_dir_sector'], iso_info['root_dir_size'] = unpack('<II', descriptor[20:28])
+        iso_info['image_size'] = len(mm)
         iso_info['volume_size'] = iso_info['image_size'] - iso_info['root_offset']
         iso_info['volume_sectors'] = iso_info['volume_size'] / iso_info['sector_size']
         return iso_info
 
-    @staticmethod
-    def extract_defaultxex(iso_file, iso_info):
-        iso_file.seek((iso_info['root_dir_sector'] * iso_info['sector_size']) + iso_info['root_offset'])
-        root_sector_buffer = io.BytesIO()
-        root_sector_buffer.write(iso_file.read(iso_info['root_dir_size']))
-        root_sector_buffer.seek(0)
-
-        for i in range(0, iso_info['root_dir_size'] - 12):
-            root_sector_buffer.seek(i)
-            root_sector_buffer.read(1)
-            if int.from_bytes(root_sector_buffer.read(1), byteorder='big') == 11:
-                if root_sector_buffer.read(11).decode("ascii", "ignore").lower() == 'default.xex':
-                    root_sector_buffer.seek(i - 8)
-                    file_sector = unpack('I', root_sector_buffer.read(4))[0]
-                    file_size = unpack('I', root_sector_buffer.read(4))[0]
-
-                    iso_file.seek(iso_info['root_offset'] + (file_sector * iso_info['sector_size']))
-                    xex_buffer = io.BytesIO()
-                    xex_buffer.write(iso_file.read(file_size))
-                    xex_buffer.seek(0)
-                    return xex_buffer
-        print('default.xex not found')
-        return False
-
-    @staticmethod
-    def extract_xex_info(xex_buffer):
+    def extract_xex_info(self, mm, xex_start, xex_size):
         xex_info = {}
 
-        xex_buffer.seek(0)
-        if xex_buffer.read(4).decode("ascii", "ignore") == 'XEX2':
-            xex_buffer.seek(0x08)
-            code_offset = unpack('>I', xex_buffer.read(4))[0]
-            if code_offset > sys.getsizeof(xex_buffer):
+        # Only the 24 byte header, the info table and the execution info block
+        # are read, the rest of default.xex is never touched
+        magic, _, code_offset, _, cert_offset, info_table_num_entries = unpack_from('>4sIIIII', mm, xex_start)
+        if magic == XEX_MAGIC:
+            if code_offset > xex_size:
                 print('Starting address of Xex code is beyond size of default.xex')
                 return False
 
-            xex_buffer.seek(0x10)
-            cert_offset = unpack('>I', xex_buffer.read(4))[0]
             if cert_offset > code_offset:
                 print('Xex certificate offset is beyond the starting address of Xex code')
                 return False
 
-            xex_buffer.seek(0x14)
-            info_table_num_entries = unpack('>I', xex_buffer.read(4))[0]
             if info_table_num_entries * 8 + 24 > code_offset:
                 print('Xex general info table has entries that spill over into the Xex code')
                 return False
 
+            table_start = xex_start + 0x18
             execution_info_address = False
-            execution_info_table_flags = bytes([0x00, 0x04, 0x00, 0x06])
-
-            for i in range(0, info_table_num_entries):
-                header_id = unpack('>I', xex_buffer.read(4))[0]
-
-                if header_id == unpack('>I', execution_info_table_flags)[0]:
-                    execution_info_address = unpack('>I', xex_buffer.read(4))[0]
-                else:
-                    xex_buffer.read(4)
+            for header_id, value in iter_unpack('>II', mm[table_start:table_start + info_table_num_entries * 8]):
+                if header_id == EXECUTION_INFO_HEADER_ID:
+                    execution_info_address = value
+                    break
 
             if execution_info_address is not False:
-                xex_buffer.seek(execution_info_address)
-                xex_info['media_id'] = binascii.hexlify(xex_buffer.read(4)).decode("ascii", "ignore").upper()
-                xex_info['version'] = unpack('>I', xex_buffer.read(4))[0]
-                xex_info['base_version'] = unpack('>I', xex_buffer.read(4))[0]
-                xex_info['title_id'] = binascii.hexlify(xex_buffer.read(4)).decode("ascii", "ignore").upper()
-                xex_info['platform'] = ord(xex_buffer.read(1))
-                xex_info['executable_type'] = ord(xex_buffer.read(1))
-                xex_info['disc_number'] = ord(xex_buffer.read(1))
-                xex_info['disc_count'] = ord(xex_buffer.read(1))
+                if execution_info_address + 20 > xex_size:
+                    print('Xex execution info is beyond size of default.xex')
+                    return False
+                (media_id, xex_info['version'], xex_info['base_version'], title_id,
+                 xex_info['platform'], xex_info['executable_type'],
+                 xex_info['disc_number'], xex_info['disc_count']) = unpack_from('>4sII4sBBBB', mm, xex_start + execution_info_address)
+                xex_info['media_id'] = media_id.hex().upper()
+
+                # Fetch game info from the loaded game lookup dictionary
+                xex_info.update(self.game_lookup.get(title_id, {}))
+                xex_info['title_id'] = title_id.hex().upper()
             else:
                 return False
 
@@ -180,70 +219,153 @@ class Xbox360ISO(object):
             print('XEX2 was not found at the start of default.xex')
             return False
 
-def main():
-    iso_parser = Xbox360ISO()
+worker_parser = None  # Set in each worker process by init_worker
+
+def init_worker(game_lookup):
+    global worker_parser
+    worker_parser = Xbox360ISO(game_lookup)
+
+def parse_worker(filename):
+    return parse_captured(worker_parser, filename)
+
+def parse_captured(iso_parser, filename):
+    # Capture what the parser prints so it can be shown under its own ISO
+    messages = io.StringIO()
+    with redirect_stdout(messages):
+        info = iso_parser.parse(filename)
+    return info, messages.getvalue()
+
+def format_info(info):
+    return (f"Game Name: {info.get('game_name', 'N/A')}\n"
+            f"Disc Number: {info.get('disc_number', 'N/A')} of {info.get('disc_count', 'N/A')}\n"
+            f"Region: {info.get('region', 'N/A')}\n"
+            f"Title ID: {info.get('title_id', 'N/A')}\n"
+            f"Media ID: {info.get('media_id', 'N/A')}\n"
+            f"Wave: {info.get('wave', 'N/A')}\n"
+            f"Serial: {info.get('serial', 'N/A')}\n"
+            f"XEX CRC: {info.get('xex_crc', 'N/A')}\n"
+#Need Fix-> f"Type: {info.get('type', 'N/A')}\n"
+            + "-" * 40 + "\n")
+
+def load_scan_cache(lookup_stamp):
+    # Results of earlier scans keyed by (iso name, size, mtime), only valid for
+    # the parser and game list they came from. JSON rather than pickle, as the
+    # file sits in whatever folder is being scanned.
+    try:
+        with open(SCAN_CACHE_FILE, 'r', encoding='utf-8') as f:
+            stamp, entries = json.load(f)
+        if stamp == lookup_stamp:
+            cache = {}
+            for key, (info, messages) in entries.items():
+                name, size, mtime_ns = key.rsplit('|', 2)
+                cache[(name, int(size), int(mtime_ns))] = (info, messages)
+            return cache
+    except Exception:
+        pass  # No usable cache, every ISO gets parsed
+    return {}
+
+def save_scan_cache(lookup_stamp, cache):
+    entries = {f"{name}|{size}|{mtime_ns}": result for (name, size, mtime_ns), result in cache.items()}
+    try:
+        with open(SCAN_CACHE_FILE + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump([lookup_stamp, entries], f)
+        os.replace(SCAN_CACHE_FILE + '.tmp', SCAN_CACHE_FILE)
+    except OSError:
+        pass  # Folder may be read-only, the cache is only a speedup
+
+def main(iso_parser):
     current_dir = os.getcwd()
-    iso_files = [f for f in os.listdir(current_dir) if f.lower().endswith('.iso')]
+    with os.scandir(current_dir) as entries:
+        iso_entries = [e for e in entries if e.name[-4:].lower() == '.iso' and e.is_file()]
+    iso_files = [e.name for e in iso_entries]
 
     all_info = []
 
     print(f"By: blahpr 2024 -> https://github.com/BLAHPR/xbox360iso/releases/latest\n\nFound {len(iso_files)} ISO(s) in {current_dir}\n")
 
-    for iso in iso_files:
-        print(f"-> {iso}")
-        info = iso_parser.parse(iso)
-        if info:
-            # Add ISO file name to the info dictionary
-            info['iso_name'] = iso
-            all_info.append(info)
-            print(f"Game Name: {info.get('game_name', 'N/A')}")
-            print(f"Disc Number: {info.get('disc_number', 'N/A')} of {info.get('disc_count', 'N/A')}")
-            print(f"Region: {info.get('region', 'N/A')}")
-            print(f"Title ID: {info.get('title_id', 'N/A')}")
-            print(f"Media ID: {info.get('media_id', 'N/A')}")
-            print(f"Wave: {info.get('wave', 'N/A')}")
-            print(f"Serial: {info.get('serial', 'N/A')}")
-            print(f"XEX CRC: {info.get('xex_crc', 'N/A')}")
-#Need Fix-> print(f"Type: {info.get('type', 'N/A')}")
-            print("-" * 40)
-        else:
-            print(f"Failed to process: {iso}")
-            print("-" * 40)
+    lookup_stamp = [SCAN_CACHE_VERSION, GAME_LOOKUP_CACHE_VERSION, iso_parser.csv_stamp]
+    cache = load_scan_cache(lookup_stamp)
+    keys = []
+    for e in iso_entries:
+        st = e.stat()
+        keys.append((e.name, st.st_size, st.st_mtime_ns))
+    new_files = [key[0] for key in keys if key not in cache]
+
+    executor = None
+    if len(new_files) > 1:
+        # Parse new or changed ISOs in parallel, each worker gets the game lookup once up front
+        workers = min(os.cpu_count() or 1, len(new_files))
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                       initargs=(iso_parser.game_lookup,))
+        results = executor.map(parse_worker, new_files)
+    else:
+        # A single ISO is not worth starting a worker process for
+        results = (parse_captured(iso_parser, iso) for iso in new_files)
+    try:
+        for key in keys:
+            if key not in cache:
+                try:
+                    cache[key] = next(results)
+                except BrokenProcessPool:
+                    # A worker died, fail the ISOs still waiting on the pool
+                    # rather than ending the scan
+                    results = itertools.repeat((None, "Worker process stopped unexpectedly\n"))
+                    cache[key] = next(results)
+            iso = key[0]
+            info, messages = cache[key]
+            # Build each ISO's report and write it in one go
+            report = io.StringIO()
+            report.write(f"-> {iso}\n")
+            report.write(messages)
+            if info:
+                # Add ISO file name to the info dictionary
+                info['iso_name'] = iso
+                all_info.append(info)
+                report.write(format_info(info))
+            else:
+                report.write(f"Failed to process: {iso}\n")
+                report.write("-" * 40 + "\n")
+            sys.stdout.write(report.getvalue())
+            sys.stdout.flush()
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
     if all_info:
         base_filename = "GameInfo"
-        counter = 1
-        filename = f"{base_filename}.txt"
-        while os.path.isfile(filename):
-            filename = f"{base_filename}_{counter}.txt"
-            counter += 1
-
-        with open(filename, "w") as file:
-            for info in all_info:
-                file.write(f"-> {info.get('iso_name', 'N/A')}\n")
-                file.write(f"Game Name: {info.get('game_name', 'N/A')}\n")
-                file.write(f"Disc Number: {info.get('disc_number', 'N/A')} of {info.get('disc_count', 'N/A')}\n")
-                file.write(f"Region: {info.get('region', 'N/A')}\n")
-                file.write(f"Title ID: {info.get('title_id', 'N/A')}\n")
-                file.write(f"Media ID: {info.get('media_id', 'N/A')}\n")
-                file.write(f"Wave: {info.get('wave', 'N/A')}\n")
-                file.write(f"Serial: {info.get('serial', 'N/A')}\n")
-                file.write(f"XEX CRC: {info.get('xex_crc', 'N/A')}\n")
-    #Need Fix-> file.write(f"Type: {info.get('type', 'N/A')}\n")
-                file.write("-" * 40 + "\n")
+        # Claim the first free name with mode "x" (O_CREAT | O_EXCL), one
+        # syscall per candidate and no race with another scan picking the same name
+        for counter in itertools.count():
+            filename = f"{base_filename}.txt" if counter == 0 else f"{base_filename}_{counter}.txt"
+            try:
+                file = open(filename, "x")
+                break
+            except FileExistsError:
+                continue
+
+        with file:
+            file.write(''.join(f"-> {info.get('iso_name', 'N/A')}\n" + format_info(info) for info in all_info))
 
             # Write the additional text at the end of the file
             file.write("\nBy: blahpr 2024 -> https://github.com/BLAHPR/xbox360iso/releases/latest\n")
 
         print(f"Text Saved to {current_dir}\\{filename}")
 
+    if keys:
+        # Only keep ISOs that are still here, and only ones that parsed, so a
+        # failure (e.g. a file locked by another program) is retried next scan
+        save_scan_cache(lookup_stamp, {key: cache[key] for key in keys if cache[key][0]})
+
     print("\nPress Enter to Scan Again...")
     input()  # Waits for user to press Enter
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # Needed for worker processes in the PyInstaller exe
+    # Loaded once per launch, edits to the CSV show up after a restart
+    iso_parser = Xbox360ISO()
     while True:
         try:
-            main()
+            main(iso_parser)
         except KeyboardInterrupt:
             print("\nExiting...")
             break